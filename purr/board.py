@@ -32,10 +32,25 @@ PURR_STATE_UNKNOWN, PURR_STATE_PURR, PURR_STATE_REPL, PURR_STATE_RAW_REPL, PURR_
 class PurrError(Exception): pass
 class TimeoutError(PurrError): pass
 
+def b64_frame(s):
+    """Return the lines that send s to the stub
+
+    The payload size goes on a line before the __STUB__ marker; stubs that
+    don't read it skip it while looking for the marker."""
+    if not isinstance(s, bytes): s = s.encode('utf-8')
+    mv = memoryview(s)
+    return ([b"\n%d\n__STUB__\n" % len(s)]
+        + [binascii.b2a_base64(mv[i:i+90]) for i in range(0, len(s), 90)]
+        + [b"~~STUB~~\n"])
+
 class PurrBoard:
     def __init__(self, comm):
         self.state = PURR_STATE_UNKNOWN
         self.comm = comm
+        self.remote_mem_peak = None
+        self.remote_functions = set()
+        self.mpy_cross = None
+        self.mpy_ok = None
 
     def do_write(self, data):
         """Write data to the attached device in blocking mode"""
@@ -75,14 +90,12 @@ class PurrBoard:
         return self.read_until(b'\n', timeout=timeout, t_end=t_end)
 
     def putb64(self, s):
-        self.write(b"\n__STUB__\n");
-        if not isinstance(s, bytes): s = s.encode('utf-8')
-        mv = memoryview(s)
-        for i in range(0, len(s), 90):
-            v = mv[i:i+90]
-            self.write(binascii.b2a_base64(v))
+        frame = b64_frame(s)
+        self.write(frame[0])
+        for line in frame[1:-1]:
+            self.write(line)
             self.read_until(b'.')
-        self.write(b"~~STUB~~\n"); self.read_until(b'\n')
+        self.write(frame[-1]); self.read_until(b'\n')
 
     def getb64g(self):
         while 1:
@@ -99,12 +112,20 @@ class PurrBoard:
     def getb64(self):
         return b"".join(self.getb64g())
     
+    def note_mem_peak(self, peak):
+        """Record the peak remote heap use reported for the last command"""
+        self.remote_mem_peak = peak
+        logging.debug("remote heap peak %d bytes", peak)
+
     def remote_generator_to_list(self):
         r = []
         while 1:
             result = self.getb64()
             result = eval(result)
             if result is None:
+                break # StopIteration (stub without heap reporting)
+            if result[0] is None:
+                self.note_mem_peak(result[1])
                 break # StopIteration
             if result[0]:
                 r.append(result[1])
@@ -119,6 +140,7 @@ class PurrBoard:
         result = eval(result)
         if result == 'generator':
             return self.remote_generator_to_list()
+        if len(result) > 2: self.note_mem_peak(result[2])
         if result[0]: return result[1]
         raise PurrError(result[1])
 
@@ -169,6 +191,7 @@ class PurrBoard:
             logging.info("Using preinstalled stub")
         self.write(b"RemoteStub().loop()\r\n")
         self.getb64()
+        self.remote_functions.clear()
         self.state = PURR_STATE_PURR
 
     def enter_repl(self, force=False, timeout=16, t_end=0):
@@ -227,5 +250,169 @@ class CommSerial:
         logging.debug("WRITE %r", data)
         self.serial.write(data)
 
+    def close(self):
+        self.serial.close()
+
 def purr_serial(port, rate=115200):
     return PurrBoard(CommSerial(port, rate))
+
+# A recording is RECORD_MAGIC followed by one event per read or write: a
+# varint of the length shifted left by one, with the low bit set for writes,
+# a varint of microseconds since the previous event, then the bytes.  Reads
+# that timed out are recorded with length 0, and reads arriving within
+# RECORD_MERGE seconds of the start of the previous read are merged into it.
+RECORD_MAGIC = b'PURRREC2'
+RECORD_MERGE = .001
+
+def encode_varint(n):
+    result = bytearray()
+    while n > 0x7f:
+        result.append(n & 0x7f | 0x80)
+        n >>= 7
+    result.append(n)
+    return result
+
+def decode_varint(data, pos):
+    """Return the varint at data[pos] and the position after it"""
+    n = shift = 0
+    while 1:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80: return n, pos
+        shift += 7
+
+class CommRecorder:
+    """Wrap another comm object, recording timestamped traffic to a file"""
+    def __init__(self, comm, f):
+        self.comm = comm
+        self.f = f
+        self.t0 = time.monotonic()
+        self.t_last = 0
+        self.pending = None
+        self.bytes_read = self.bytes_written = 0
+        f.write(RECORD_MAGIC)
+
+    def record(self, is_write, t, data):
+        t = round((t - self.t0) * 1e6)
+        self.f.write(encode_varint(len(data) << 1 | is_write) + encode_varint(t - self.t_last))
+        self.f.write(data)
+        self.t_last = t
+
+    def flush(self):
+        if self.pending:
+            self.record(0, *self.pending)
+            self.pending = None
+
+    def read_deadline(self, min_bytes, t_end):
+        data = self.comm.read_deadline(min_bytes, t_end)
+        t = time.monotonic()
+        self.bytes_read += len(data)
+        if data and self.pending and self.pending[1] and t - self.pending[0] < RECORD_MERGE:
+            self.pending[1] += data
+        else:
+            self.flush()
+            self.pending = [t, bytearray(data)]
+        return data
+
+    def write(self, data):
+        data = bytes(data)
+        self.flush()
+        self.record(1, time.monotonic(), data)
+        self.bytes_written += len(data)
+        return self.comm.write(data)
+
+    def close(self):
+        self.flush()
+        self.f.close()
+        self.comm.close()
+
+def load_recording(f):
+    """Return the (kind, timestamp, data) events of a recording
+
+    A recording cut short, for instance by a killed session, is replayed up
+    to its last complete event."""
+    data = f.read()
+    if not data.startswith(RECORD_MAGIC):
+        raise PurrError("Not a purr recording")
+    events = []
+    pos = len(RECORD_MAGIC)
+    t = 0
+    try:
+        while pos < len(data):
+            header, pos = decode_varint(data, pos)
+            delta, pos = decode_varint(data, pos)
+            end = pos + (header >> 1)
+            if end > len(data): raise IndexError
+            t += delta
+            events.append((b'w' if header & 1 else b'r', t / 1e6, data[pos:end]))
+            pos = end
+    except IndexError:
+        logging.warning("Recording is truncated after %d events", len(events))
+    return events
+
+class CommReplay:
+    """Play back a recording in place of a real board
+
+    Each recorded read is delivered at its original delay after the event
+    before it, multiplied by timescale; a timescale of 0 replays as fast as
+    possible.  Writes are checked against the recording; a mismatch is
+    logged, or raises PurrError if strict is set."""
+    def __init__(self, events, timescale=1., strict=False):
+        self.events = events
+        self.timescale = timescale
+        self.strict = strict
+        self.pos = 0
+        self.offset = 0
+        self.t_real = time.monotonic()
+        self.t_rec = 0
+        self.bytes_read = self.bytes_written = 0
+
+    def take(self, min_bytes):
+        data = self.events[self.pos][2]
+        chunk = data[self.offset:self.offset + min_bytes]
+        self.offset += len(chunk)
+        if self.offset == len(data):
+            self.pos += 1
+            self.offset = 0
+        self.bytes_read += len(chunk)
+        return chunk
+
+    def read_deadline(self, min_bytes, t_end):
+        if self.pos < len(self.events) and self.events[self.pos][0] == b'r':
+            if self.offset: return self.take(min_bytes)
+            t_due = self.t_real + (self.events[self.pos][1] - self.t_rec) * self.timescale
+            # A recorded timeout was timed when the original read gave up,
+            # which can be a little after the deadline of this read
+            if not self.events[self.pos][2]: t_due = min(t_due, t_end)
+            if t_due <= t_end:
+                time.sleep(max(0, t_due - time.monotonic()))
+                self.t_real = time.monotonic()
+                self.t_rec = self.events[self.pos][1]
+                return self.take(min_bytes)
+        time.sleep(max(0, t_end - time.monotonic()))
+        return b''
+
+    def write(self, data):
+        data = bytes(data)
+        self.bytes_written += len(data)
+        expected = None
+        if self.pos < len(self.events) and self.events[self.pos][0] == b'w':
+            kind, self.t_rec, expected = self.events[self.pos]
+            self.t_real = time.monotonic()
+            self.pos += 1
+        if data == expected: return
+        if self.strict:
+            raise PurrError("Replay diverged: wrote %r, recording has %r" % (data, expected))
+        logging.warning("Replay diverged: wrote %r, recording has %r", data, expected)
+
+    def close(self):
+        pass
+
+def purr_record(port, filename, rate=115200):
+    return PurrBoard(CommRecorder(CommSerial(port, rate), open(filename, 'wb')))
+
+def purr_replay(filename, timescale=1., strict=False):
+    with open(filename, 'rb') as f:
+        events = load_recording(f)
+    return PurrBoard(CommReplay(events, timescale, strict))
@@ -24,7 +24,7 @@ import posixpath
 import sys
 import tempfile
 
-from .board import purr_serial, rstub_src
+from .board import purr_serial, purr_record, rstub_src
 import purr.commands as commands
 
 board = None
@@ -36,9 +36,17 @@ def sq(x): return '\'' + x.replace('\'', '\'\\\'\'') + '\''
     type=click.STRING, help='''Serial port to use.  [Environment: PURR_PORT]''')
 @click.option('--baud', '-b', default=115200, type=click.INT,
     help='''Baud rate''')
-def cli(port, baud):
+@click.option('--record', envvar='PURR_RECORD', type=click.Path(dir_okay=False, writable=True),
+    help='''Record serial traffic to this file for later replay.  [Environment: PURR_RECORD]''')
+@click.option('--mpy-cross', envvar='PURR_MPY_CROSS', help="If specified, invoke this mpy-cross to compile purr's remote helper functions, which are then cached on the board in /.purr.  Separate from the --mpy-cross option of put and upload_stub.  Passed to the shell, so quote properly [Environment: PURR_MPY_CROSS]")
+def cli(port, baud, record=None, mpy_cross=None):
     global board
-    board = purr_serial(port, baud)
+    if record:
+        board = purr_record(port, record, baud)
+    else:
+        board = purr_serial(port, baud)
+    click.get_current_context().call_on_close(board.comm.close)
+    board.mpy_cross = mpy_cross
 
 def local_checksum(filename):
     import hashlib
@@ -14,44 +14,162 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import builtins
 import inspect
 import functools
 import contextlib
+import hashlib
 import logging
-
-from .board import rstub_src
-
-def remote(fun):
+import os
+import shlex
+import tempfile
+
+from .board import PurrError, rstub_src
+
+_mpy_cache = {}
+
+def compile_mpy(mpy_cross, name, src):
+    """Compile src with mpy_cross, returning the .mpy content or None on failure"""
+    key = mpy_cross, src
+    if key not in _mpy_cache:
+        mpy = None
+        with tempfile.TemporaryDirectory() as d:
+            py_file = os.path.join(d, name + '.py')
+            mpy_file = os.path.join(d, name + '.mpy')
+            with builtins.open(py_file, 'w') as f: f.write(src)
+            status = os.system("%s -s %s -o %s %s" % (mpy_cross,
+                shlex.quote(name + '.py'), shlex.quote(mpy_file), shlex.quote(py_file)))
+            if status == 0 and os.path.exists(mpy_file):
+                with builtins.open(mpy_file, 'rb') as f: mpy = f.read()
+            else:
+                logging.warning("mpy-cross failed for %s, sending source", name)
+        _mpy_cache[key] = mpy
+    return _mpy_cache[key]
+
+def load_mpy(purr, name, mpy):
+    """Load the function name from compiled mpy content on the board
+
+    Modules are cached on the board in /.purr, named after the bytecode
+    version, a hash of their content and the function name.  Returns False
+    if the board cannot load this bytecode version or cannot store it."""
+    if purr.mpy_ok is None:
+        version = rmpyversion(purr)
+        if version is not None and version & 0xff != mpy[1]:
+            return False
+        purr.mpy_ok = True
+    modname = 'm%03d_%s_%s' % (mpy[1], hashlib.sha256(mpy).hexdigest()[:12], name)
+    loaded = rimport(purr, name, modname)
+    if loaded is None:
+        # Upload under a temporary name, so an interrupted upload never
+        # leaves a truncated module where rimport would find it
+        filename = '/.purr/%s.mpy' % modname
+        try:
+            putfile(purr, filename + '.tmp', mpy)
+            purr.send_purr_command('os.rename', filename + '.tmp', filename)
+        except PurrError as e:
+            if not isinstance(e.args[0], OSError): raise
+            logging.warning("Cannot store bytecode on the board: %s", e)
+            return False
+        loaded = rimport(purr, name, modname)
+    return bool(loaded)
+
+def send_function(purr, name, src, mpy=True):
+    if mpy and purr.mpy_cross and purr.mpy_ok is not False:
+        content = compile_mpy(purr.mpy_cross, name, src)
+        if content is not None:
+            try:
+                if load_mpy(purr, name, content): return
+                logging.warning("Board cannot use bytecode from %s, sending source", purr.mpy_cross)
+                purr.mpy_ok = False
+            except PurrError as e:
+                logging.warning("Loading bytecode for %s failed, sending source: %s", name, e)
+    purr.send_purr_command('exec', src)
+
+def remote(fun=None, *, mpy=True):
+    """Make fun, a function taking the stub as its first argument, run remotely
+
+    If the board has mpy_cross set, the function is sent as precompiled
+    bytecode unless mpy=False.  Compiled functions each get their own
+    globals, so keep any state shared between them on the stub."""
+    if fun is None: return functools.partial(remote, mpy=mpy)
     src = None
     @functools.wraps(fun)
     def inner(purr, *args):
         nonlocal src
-        if src is None:
-            src = inspect.getsource(fun)
-            startdef = src.find("def ")
-            src = src[startdef:]
-            purr.send_purr_command('exec', src)
+        purr.enter_purr()
+        if fun.__name__ not in purr.remote_functions:
+            if src is None:
+                src = inspect.getsource(fun)
+                startdef = src.find("def ")
+                src = src[startdef:]
+            send_function(purr, fun.__name__, src, mpy)
+            purr.remote_functions.add(fun.__name__)
         return purr.send_purr_command('rfunc', fun.__name__, *args)
     return inner
 
-@remote
+# These must stay as source: they share the global fd, and they are used
+# to upload compiled functions to the board.
+@remote(mpy=False)
 def open(stub, filename, mode='rb'):
     global fd
     fd = open(filename, mode)
 
-@remote
+@remote(mpy=False)
 def close(stub):
     global fd
     fd.close()
 
-@remote
+@remote(mpy=False)
 def read(stub, count):
     return fd.read(count)
 
-@remote
+@remote(mpy=False)
 def write(stub, buf):
     return fd.write(buf)
 
+# The board's .mpy version, or None if it does not say
+@remote(mpy=False)
+def rmpyversion(stub):
+    import sys
+    impl = getattr(sys, 'implementation', None)
+    return getattr(impl, '_mpy', getattr(impl, 'mpy', None))
+
+# Returns True once loaded, None if the module is not on the board (after
+# making sure its directory exists and removing older modules for the same
+# function and bytecode version), and False if the board cannot load this
+# .mpy version or cannot write to /.purr.
+@remote(mpy=False)
+def rimport(stub, name, modname):
+    import sys
+    try:
+        import os
+    except:
+        import uos as os
+    if '/.purr' not in sys.path: sys.path.append('/.purr')
+    try:
+        mod = __import__(modname)
+    except ImportError:
+        try:
+            os.mkdir('/.purr')
+        except OSError:
+            pass
+        try:
+            for f in os.listdir('/.purr'):
+                if (len(f) == len(modname) + 4 and f[:5] == modname[:5]
+                        and f.endswith('_' + name + '.mpy')):
+                    os.unlink('/.purr/' + f)
+        except OSError:
+            return False
+        return None
+    except ValueError:
+        try:
+            os.unlink('/.purr/' + modname + '.mpy')
+        except OSError:
+            pass
+        return False
+    stub.state[name] = getattr(mod, name)
+    return True
+
 @remote
 def checksum(stub, filename, chunksize=256):
     try:
@@ -79,6 +197,7 @@ def checksum(stub, filename, chunksize=256):
 
 @remote
 def lsl(stub, location):
+    import os
     S_IFDIR = 16384
     if not location.endswith("/"): location += "/"
     for o in os.listdir(location):
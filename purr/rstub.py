@@ -24,45 +24,114 @@ try:
 except:
     import uos as os
 
+import gc
 import sys
 
+try:
+    mem_alloc = gc.mem_alloc
+except:
+    def mem_alloc(): return 0
+
 def gen(): yield
 gentype = type(gen())
 
+STUB = b'__STUB__'
+ENDSTUB = b'~~STUB~~'
+# A full base64 line encodes 90 bytes: 120 characters plus the newline
+LINE = 121
+
 class RemoteStub:
-    def __init__(self, f_in=sys.stdin, f_out=sys.stdout):
+    # The default bufsize holds the request for write() of a 256-byte putfile
+    # chunk even if every byte is escaped, so transfers reuse one buffer
+    def __init__(self, f_in=sys.stdin, f_out=sys.stdout, bufsize=1088):
         self.f_in = getattr(f_in, 'buffer', f_in)
         self.f_out = getattr(f_out, 'buffer', f_out)
         self.state = {}
+        self.ch = bytearray(1)
+        self.line = bytearray(LINE)
+        self.linemv = memoryview(self.line)
+        self.bufsize = bufsize
+        self.rx = bytearray(bufsize)
+        self.rxmv = memoryview(self.rx)
+        self.peak = 0
 
     def eval(self, s): return eval(s, globals(), self.state)
 
     def exec(self, s): return exec(s, globals(), self.state)
 
+    def sample(self):
+        m = mem_alloc()
+        if m > self.peak: self.peak = m
+
     def putb64(self, s):
         self.f_out.write(b"__STUB__\n")
         mv = memoryview(s)
         for i in range(0, len(s), 90):
-            v = mv[i:i+90]
-            self.f_out.write(binascii.b2a_base64(v))
+            self.f_out.write(binascii.b2a_base64(mv[i:i+90]))
         self.f_out.write(b"~~STUB~~\n")
 
-    def getb64g(self):
-        while 1:
-            line = self.f_in.readline().strip()
-            if line == b'__STUB__':
-                self.f_out.write(".")
-                break
+    # Read input a byte at a time through the __STUB__ line, and return the
+    # payload size the host sends on the line before it, or -1 if missing
+    def sync(self):
+        ch = self.ch
+        line = self.line
+        size = -1
         while 1:
-            line = self.f_in.readline().strip()
-            if line == b'~~STUB~~':
-                self.f_out.write("\n")
-                break
+            n = 0
+            while 1:
+                self.f_in.readinto(ch)
+                if ch[0] == 10: break
+                if ch[0] > 32 and n < LINE:
+                    line[n] = ch[0]
+                    n += 1
+            if n == 8 and line[:8] == STUB: return size
+            size = 0 if n else -1
+            for i in range(n):
+                c = line[i] - 48
+                if c < 0 or c > 9:
+                    size = -1
+                    break
+                size = size * 10 + c
+
+    # Decode the next payload into self.rx and return its length.  Each
+    # line's length follows from the payload size, so it is a single read.
+    def getb64into(self):
+        size = self.sync()
+        if size < 0: raise ValueError("missing payload size")
+        self.f_out.write(".")
+        if size > len(self.rx):
+            self.rxmv = self.rx = None
+            self.rx = bytearray(size)
+            self.rxmv = memoryview(self.rx)
+        line = self.line
+        linemv = self.linemv
+        pos = 0
+        while pos < size:
+            k = min(size - pos, 90)
+            n = (k + 2) // 3 * 4
+            if self.f_in.readinto(linemv[:n+1]) != n + 1 or line[n] != 10:
+                raise ValueError("bad stub line")
             self.f_out.write(".")
-            yield binascii.a2b_base64(line)
+            chunk = binascii.a2b_base64(linemv[:n])
+            if len(chunk) != k: raise ValueError("bad stub line")
+            self.rx[pos:pos+k] = chunk
+            pos += k
+        if self.f_in.readinto(linemv[:9]) != 9 or line[8] != 10 or line[:8] != ENDSTUB:
+            raise ValueError("bad stub line")
+        self.f_out.write("\n")
+        self.sample()
+        return pos
 
+    # Copy the payload out for eval, and drop a buffer grown past bufsize
+    # so one large payload does not stay allocated between requests
     def getb64(self):
-        return b"".join(self.getb64g())
+        n = self.getb64into()
+        data = bytes(self.rxmv[:n])
+        if len(self.rx) > self.bufsize:
+            self.rxmv = self.rx = None
+            self.rx = bytearray(self.bufsize)
+            self.rxmv = memoryview(self.rx)
+        return data
 
     def getfunction(self, function):
         if '.' in function:
@@ -78,11 +147,11 @@ class RemoteStub:
     def loop(self):
         self.putb64(b'')
         while 1:
+            gc.collect()
+            self.peak = 0
+            self.sample()
             try:
-                funcargs = self.getb64()
-                print("X", funcargs)
-                function, args = eval(funcargs)
-                print("Y")
+                function, args = eval(self.getb64())
                 if function == 'exit':
                     return
 
@@ -91,16 +160,18 @@ class RemoteStub:
             except Exception as e:
                 sys.print_exception(e)
                 result = False, e
+            self.sample()
             if result[0] and type(result[1]) is gentype:
                 self.putb64(repr('generator'))
                 try:
                     for i in result[1]:
+                        self.sample()
                         self.putb64(repr((True, i)))
                 except Exception as e:
                     self.putb64((False, e))
                     return
-                self.putb64(repr(None))
+                self.putb64(repr((None, self.peak)))
             else:
-                self.putb64(repr(result))
+                self.putb64(repr(result + (self.peak,)))
 
     def rfunc(self, fname, *args): return self.state[fname](self, *args)
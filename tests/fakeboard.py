@@ -0,0 +1,85 @@
+# CircuitPython remote access
+# Copyright © 2018 Jeff Epler <jepler@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import threading
+import time
+
+import purr.rstub as rstub
+
+class HostStub(rstub.RemoteStub):
+    # On the board, str supports the buffer protocol; on the host it doesn't
+    def putb64(self, s):
+        if isinstance(s, str): s = s.encode('utf-8')
+        super().putb64(s)
+
+class Console:
+    def __init__(self, board): self.board = board
+
+    def write(self, data): self.board.send(data)
+
+class FakeBoard:
+    """Just enough of a board's REPL to start a RemoteStub in a thread"""
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.output = bytearray()
+        self.line = b''
+        self.stub_in = None
+
+    def send(self, data):
+        if isinstance(data, str): data = data.encode('utf-8')
+        with self.cond:
+            self.output += data
+            self.cond.notify()
+
+    def read_deadline(self, min_bytes, t_end):
+        with self.cond:
+            while not self.output:
+                t = time.monotonic()
+                if t >= t_end: return b''
+                self.cond.wait(t_end - t)
+            data = bytes(self.output[:min_bytes])
+            del self.output[:min_bytes]
+            return data
+
+    def write(self, data):
+        if self.stub_in:
+            self.stub_in.write(data)
+            return
+        for c in data:
+            if c == 3:
+                self.line = b''
+                self.send(b"\r\n>>> ")
+            elif c == ord('\n'):
+                self.run(self.line.strip())
+                self.line = b''
+            elif c > 3:
+                self.line += bytes([c])
+
+    def run(self, line):
+        self.send(line + b"\r\n")
+        if line == b"RemoteStub().loop()":
+            r, w = os.pipe()
+            self.stub_in = os.fdopen(w, 'wb', buffering=0)
+            stub = HostStub(os.fdopen(r, 'rb'), Console(self))
+            threading.Thread(target=stub.loop, daemon=True).start()
+        elif line == b"RemoteStub":
+            self.send(b"<class 'RemoteStub'>\r\n>>> ")
+        else:
+            self.send(b">>> ")
+
+    def close(self):
+        if self.stub_in: self.stub_in.close()
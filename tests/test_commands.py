@@ -0,0 +1,123 @@
+# CircuitPython remote access
+# Copyright © 2018 Jeff Epler <jepler@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+import pytest
+
+from purr.board import PurrError
+import purr.commands as commands
+
+class ScriptedBoard:
+    """Answers the commands that sending a remote function uses"""
+    def __init__(self, mpy_cross, version=None, imports=(), open_error=None):
+        self.mpy_cross = mpy_cross
+        self.mpy_ok = None
+        self.remote_functions = set()
+        self.version = version
+        self.imports = list(imports)
+        self.open_error = open_error
+        self.calls = []
+
+    def enter_purr(self): pass
+
+    def rfuncs(self):
+        """The remote functions called, leaving out sending their source"""
+        return [call for call in self.calls if call[0] != 'exec']
+
+    def send_purr_command(self, fun, *args):
+        if fun == 'exec':
+            self.calls.append(('exec', args[0].split('(')[0][4:]))
+        elif fun == 'rfunc':
+            self.calls.append(args[:2] if args[0] == 'open' else args[:1])
+            if args[0] == 'rmpyversion': return self.version
+            if args[0] == 'open' and self.open_error: raise self.open_error
+            if args[0] == 'rimport':
+                result = self.imports.pop(0)
+                if isinstance(result, Exception): raise result
+                return result
+        else:
+            self.calls.append((fun,) + args)
+
+@pytest.fixture
+def mpy_cross(tmp_path):
+    script = tmp_path / "mpy-cross"
+    script.write_text("#!/bin/sh\n{ printf 'M\\005\\000\\037'; cat \"$5\"; } > \"$4\"\n")
+    script.chmod(0o755)
+    return str(script)
+
+def sent_source(board, name):
+    return ('exec', name) in board.calls
+
+def test_compile_mpy(mpy_cross):
+    src = "def f(stub): pass\n"
+    assert commands.compile_mpy(mpy_cross, 'f', src) == b'M\x05\x00\x1f' + src.encode()
+
+def test_compile_failure_sends_source():
+    board = ScriptedBoard('false')
+    commands.uname(board)
+    assert sent_source(board, 'uname')
+    assert board.mpy_ok is None
+
+def test_version_mismatch_sends_no_upload(mpy_cross):
+    board = ScriptedBoard(mpy_cross, version=6 | 2 << 8)
+    commands.uname(board)
+    assert board.rfuncs() == [('rmpyversion',), ('uname',)]
+    assert sent_source(board, 'uname')
+    assert board.mpy_ok is False
+
+def test_upload_then_import(mpy_cross):
+    board = ScriptedBoard(mpy_cross, version=5, imports=[None, True])
+    commands.uname(board)
+    assert not sent_source(board, 'uname')
+    assert board.mpy_ok is True
+    assert board.rfuncs()[-5:-3] == [('write',), ('close',)]
+    rename, filename, target = board.rfuncs()[-3]
+    assert rename == 'os.rename'
+    assert filename == target + '.tmp' and target.startswith('/.purr/m005_')
+    assert ('open', filename) in board.calls
+    assert board.rfuncs()[-2:] == [('rimport',), ('uname',)]
+
+def test_cached_module_is_not_uploaded(mpy_cross):
+    board = ScriptedBoard(mpy_cross, imports=[True])
+    commands.uname(board)
+    assert not sent_source(board, 'uname')
+    assert not any(call[0] == 'open' for call in board.calls)
+
+def test_load_error_sends_source_for_that_function(mpy_cross):
+    board = ScriptedBoard(mpy_cross, imports=[PurrError(MemoryError()), True])
+    commands.uname(board)
+    commands.lsl(board, '/')
+    assert sent_source(board, 'uname')
+    assert not sent_source(board, 'lsl')
+    assert board.mpy_ok is True
+
+def test_readonly_filesystem_disables_bytecode(mpy_cross):
+    board = ScriptedBoard(mpy_cross, imports=[None], open_error=PurrError(OSError(30)))
+    commands.uname(board)
+    commands.lsl(board, '/')
+    assert sent_source(board, 'uname') and sent_source(board, 'lsl')
+    assert board.mpy_ok is False
+    assert board.rfuncs().count(('rimport',)) == 1
+
+@commands.remote(mpy=False)
+def source_only(stub):
+    return 1
+
+def test_remote_without_mpy(mpy_cross):
+    board = ScriptedBoard(mpy_cross)
+    source_only(board)
+    assert board.calls == [('exec', 'source_only'), ('source_only',)]
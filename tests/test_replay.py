@@ -0,0 +1,71 @@
+# CircuitPython remote access
+# Copyright © 2018 Jeff Epler <jepler@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+
+import pytest
+
+from purr.board import PurrBoard, CommRecorder, load_recording, purr_replay
+import purr.commands as commands
+
+from fakeboard import FakeBoard
+
+def record_session(filename):
+    board = PurrBoard(CommRecorder(FakeBoard(), open(filename, 'wb')))
+    result = commands.uname(board), board.eval("'x' * 1000")
+    board.comm.close()
+    return result
+
+def replay_session(filename, timescale=0):
+    board = purr_replay(filename, timescale=timescale, strict=True)
+    return commands.uname(board), board.eval("'x' * 1000")
+
+def test_replay_twice(tmp_path):
+    filename = str(tmp_path / "session.purr")
+    expected = record_session(filename)
+    assert replay_session(filename) == expected
+    assert replay_session(filename) == expected
+
+@pytest.mark.parametrize('timescale', [1, .5])
+def test_replay_timing(tmp_path, timescale):
+    filename = str(tmp_path / "session.purr")
+    t0 = time.monotonic()
+    expected = record_session(filename)
+    duration = time.monotonic() - t0
+    t0 = time.monotonic()
+    assert replay_session(filename, timescale) == expected
+    # Recorded timeouts end at the host's own deadline, so the replay
+    # can't go much faster than the fixed delays in PurrBoard
+    assert time.monotonic() - t0 < duration * 1.5
+
+def test_recording_merges_reads(tmp_path):
+    filename = str(tmp_path / "session.purr")
+    record_session(filename)
+    with open(filename, 'rb') as f:
+        events = load_recording(f)
+    traffic = sum(len(data) for kind, t, data in events)
+    assert os.path.getsize(filename) < 2 * traffic
+
+def test_truncated_recording(tmp_path):
+    filename = str(tmp_path / "session.purr")
+    record_session(filename)
+    with open(filename, 'rb') as f:
+        events = load_recording(f)
+    with open(filename, 'rb+') as f:
+        f.truncate(os.path.getsize(filename) - 1)
+    with open(filename, 'rb') as f:
+        assert load_recording(f) == events[:-1]
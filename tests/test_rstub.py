@@ -0,0 +1,93 @@
+# CircuitPython remote access
+# Copyright © 2018 Jeff Epler <jepler@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import binascii
+import io
+
+import pytest
+
+from purr.board import PurrBoard, b64_frame
+import purr.rstub as rstub
+
+from fakeboard import FakeBoard, HostStub
+
+class Output:
+    def __init__(self): self.data = bytearray()
+
+    def write(self, data):
+        if isinstance(data, str): data = data.encode('utf-8')
+        self.data += data
+
+    def replies(self):
+        """Decode the payloads the stub sent"""
+        result = []
+        for block in bytes(self.data).split(b"__STUB__\n")[1:]:
+            lines = block.split(b"~~STUB~~")[0].split(b"\n")
+            result.append(b"".join(binascii.a2b_base64(l) for l in lines if l))
+        return result
+
+def make_stub(*payloads, bufsize=1088):
+    f_in = io.BytesIO(b"".join(b"".join(b64_frame(p)) for p in payloads))
+    return HostStub(f_in, Output(), bufsize=bufsize)
+
+def test_multiline_payload_grows_and_shrinks():
+    payload = bytes(range(256)) * 20
+    stub = make_stub(payload, b'small', bufsize=16)
+    assert stub.getb64() == payload
+    assert len(stub.rx) == 16
+    assert stub.getb64() == b'small'
+
+def test_buffer_reused_within_bufsize():
+    stub = make_stub(b'a' * 1000, b'b' * 10)
+    rx = stub.rx
+    assert stub.getb64() == b'a' * 1000
+    assert stub.getb64() == b'b' * 10
+    assert stub.rx is rx
+
+def test_empty_payload():
+    assert make_stub(b'').getb64() == b''
+
+def test_long_line_is_error():
+    frame = b64_frame(b'x' * 10)
+    frame[1] = b'A' * 200 + b'\n'
+    stub = HostStub(io.BytesIO(b"".join(frame)), Output())
+    with pytest.raises(ValueError):
+        stub.getb64()
+
+def test_missing_size_is_error():
+    frame = b64_frame(b'x' * 10)
+    frame[0] = b"\n__STUB__\n"
+    stub = HostStub(io.BytesIO(b"".join(frame)), Output())
+    with pytest.raises(ValueError):
+        stub.getb64()
+
+def test_peak_in_replies(monkeypatch):
+    monkeypatch.setattr(rstub, 'mem_alloc', lambda: 1234)
+    stub = make_stub(repr(('eval', ('6*7',))),
+        repr(('eval', ('(i for i in range(2))',))),
+        repr(('exit', ())))
+    stub.loop()
+    replies = [eval(r) for r in stub.f_out.replies()[1:]]
+    assert replies == [(True, 42, 1234), 'generator', (True, 0), (True, 1), (None, 1234)]
+
+def test_host_records_peak(monkeypatch):
+    monkeypatch.setattr(rstub, 'mem_alloc', lambda: 1234)
+    board = PurrBoard(FakeBoard())
+    assert board.eval('6*7') == 42
+    assert board.remote_mem_peak == 1234
+    assert board.send_purr_command('eval', '(i for i in range(2))') == [0, 1]
+    assert board.remote_mem_peak == 1234
+    board.comm.close()